@@ -20,23 +20,134 @@ Implementation Notes
 
 """
 
+# pylint: disable=too-many-lines
+
 # imports
 import sys
 import os
+import io
 import shutil
+import stat
+import errno
 import subprocess
-import fcntl
+import selectors
+import shlex
 import platform
-import fileinput
+import tempfile
 import re
 import pwd
+import grp
+import functools
+from contextlib import contextmanager
 from datetime import datetime
-from clint.textui import colored, prompt
 import adafruit_platformdetect
 
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_Python_Shell.git"
 
+_ARMHF_RE = re.compile(r"armv.l")
+_IS_ROOT = os.geteuid() == 0
+# One uname(2) call instead of the platform module's fallback chain
+_UNAME = os.uname()
+_SYSTEM = _UNAME.sysname
+_HOME = os.path.expanduser("~")
+_MACHINE = _UNAME.machine
+_RELEASE = _UNAME.release
+_IS_ARMHF = bool(_ARMHF_RE.match(_MACHINE))
+_VERSION_RE = re.compile(r"(\d+)(?:\.(\d+))?(?:\.(\d+))?")
+
+_OS_RELEASES = (
+    "Raspbian",
+    "Debian",
+    "Kano",
+    "Mate",
+    "PiTop",
+    "Ubuntu",
+    "Darwin",
+    "Kali",
+)
+_OS_NAMES = {opsys.lower(): opsys for opsys in _OS_RELEASES}
+
+_ANSI_COLORS = {
+    "black": "\x1b[30m",
+    "red": "\x1b[31m",
+    "green": "\x1b[32m",
+    "yellow": "\x1b[33m",
+    "blue": "\x1b[34m",
+    "magenta": "\x1b[35m",
+    "cyan": "\x1b[36m",
+    "white": "\x1b[37m",
+}
+_ANSI_RESET = "\x1b[0m"
+_CLEAR_SCREEN = "\x1b[H\x1b[2J"
+_READ_SIZE = 1 << 16
+# How often to check whether the command exited when pidfds are unavailable
+_EXIT_POLL = 0.1
+# Characters that need a real shell to interpret them
+_SHELL_CHARS = frozenset("|&;<>()$`\\*?[]{}#~!\n")
+# Whether subprocess can use posix_spawn() on this platform (glibc 2.24+)
+_POSIX_SPAWN = getattr(subprocess, "_USE_POSIX_SPAWN", False)
+
+_DETECTOR = None
+
+
+def _detector():
+    """Return a shared PlatformDetect Detector, creating it on first use"""
+    global _DETECTOR  # pylint: disable=global-statement
+    if _DETECTOR is None:
+        _DETECTOR = adafruit_platformdetect.Detector()
+    return _DETECTOR
+
+
+def _decode(data):
+    """Decode process output to text with universal newlines"""
+    return data.decode("utf-8", "replace").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _pop_lines(buffer):
+    """Remove the complete lines from the start of a bytearray and return them"""
+    # A trailing \r may be the first half of a \r\n, so wait for the next byte
+    end = max(buffer.rfind(b"\n"), buffer.rfind(b"\r", 0, len(buffer) - 1))
+    if end < 0:
+        return []
+    lines = buffer[: end + 1].splitlines()
+    del buffer[: end + 1]
+    return lines
+
+
+def _pidfd_open(pid):
+    """Return a file descriptor that is readable once the process exits"""
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        # Not Linux 5.3+, so fall back to checking on the process now and then
+        return None
+
+
+def _colorize(text, color):
+    """Wrap text in an ANSI color escape when output is going to a terminal"""
+    if sys.stdout.isatty():
+        return _ANSI_COLORS[color] + text + _ANSI_RESET
+    return text
+
+
+@functools.lru_cache(maxsize=None)
+def _getpwnam(user):
+    """Look up a user's password database entry, once per user name"""
+    return pwd.getpwnam(user)
+
+
+@functools.lru_cache(maxsize=None)
+def _version_tuple(version):
+    """Parse a version such as '5.10.63-v7+' into a comparable (5, 10, 63) tuple"""
+    if isinstance(version, tuple):
+        parts = tuple(int(part) for part in version)
+        return parts + (0,) * (3 - len(parts))
+    match = _VERSION_RE.match(str(version))
+    if match is None:
+        raise ValueError(f"Invalid version '{version}'")
+    return tuple(int(part) for part in match.groups(default="0"))
+
 
 # pylint: disable=too-many-public-methods
 class Shell:
@@ -47,44 +158,41 @@ class Shell:
 
     def __init__(self):
         self._group = None
+        self._group_green = ""
+        self._group_yellow = ""
+        self._group_red = ""
         self._dirstack = []
+        self._os_cache = {}
 
     @staticmethod
     def select_n(message, selections):
         """
         Display a list of selections for the user to enter
         """
-        options = []
-
-        for index, selection in enumerate(selections):
-            options.append(
-                {
-                    "selector": str(index + 1),
-                    "prompt": selection,
-                    "return": index + 1,
-                }
-            )
-        return prompt.options(message, options)
+        options = {str(number): number for number in range(1, len(selections) + 1)}
+        menu = "".join(
+            f"[{number}] {selection}\n"
+            for number, selection in enumerate(selections, 1)
+        )
+        while True:
+            reply = input(f"{message}\n{menu}\n").strip()
+            if reply in options:
+                return options[reply]
+            print(_colorize("Select from the list of valid options.", "yellow"))
 
     def run_command(
         self, cmd, suppress_message=False, return_output=False, run_as_user=None
     ):
         """
-        Run a shell command and show the output as it runs
+        Run a shell command and show the output as it runs. The command may also
+        be given as a list of arguments. Either way, a shell is only started
+        when the command actually needs one. Returns once the command exits,
+        even if a background job it started still has the output open.
         """
 
-        def read_stream(output):
-            file_descriptor = output.fileno()
-            file_flags = fcntl.fcntl(file_descriptor, fcntl.F_GETFL)
-            fcntl.fcntl(file_descriptor, fcntl.F_SETFL, file_flags | os.O_NONBLOCK)
-            try:
-                return output.read()
-            except TypeError:
-                return ""
-
         # Allow running as a different user if we are root
         if self.is_root() and run_as_user is not None:
-            pw_record = pwd.getpwnam(run_as_user)
+            pw_record = _getpwnam(run_as_user)
             env = os.environ.copy()
             env["HOME"] = pw_record.pw_dir
             env["LOGNAME"] = run_as_user
@@ -98,50 +206,223 @@ class Shell:
             env = None
             preexec = None
 
-        full_output = ""
-        with subprocess.Popen(  # pylint: disable=subprocess-popen-preexec-fn
+        # Output that nobody will see is thrown away by the kernel, not piped
+        with self._popen(
             cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
+            stdout=subprocess.PIPE
+            if return_output or not suppress_message
+            else subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL if suppress_message else subprocess.PIPE,
+            bufsize=_READ_SIZE,
             env=env,
             preexec_fn=preexec,
         ) as proc:
-            while proc.poll() is None:
-                err = read_stream(proc.stderr)
-                if err != "" and not suppress_message:
-                    self.error(err.strip(), end="\n\r")
-                output = read_stream(proc.stdout)
-                if output != "" and not suppress_message:
-                    self.info(output.strip(), end="\n\r")
-                full_output += output
-            return_code = proc.poll()
-            proc.stdout.close()
-            proc.stderr.close()
+            if not suppress_message or return_output:
+                full_output = self._stream_output(
+                    proc, not suppress_message, return_output
+                )
+            return_code = proc.wait()
             if return_output:
-                return full_output
+                return _decode(full_output)
             if return_code:
                 return False
             return True
 
+    def _popen(self, cmd, **kwargs):
+        """
+        Start the command, only going through a shell when it needs one. Where
+        posix_spawn() is available, commands without run_as_user are started
+        with it and without close_fds, so they inherit any file descriptors
+        the caller has marked inheritable.
+        """
+        args, executable = self._command_args(cmd)
+        if args is not None:
+            # subprocess needs an absolute executable, no preexec_fn and no
+            # close_fds before it will use posix_spawn()
+            if not _POSIX_SPAWN or kwargs.get("preexec_fn") is not None:
+                executable = None
+            elif executable is None:
+                executable = shutil.which(args[0])
+            try:
+                # pylint: disable=consider-using-with
+                return subprocess.Popen(
+                    args,
+                    executable=executable,
+                    close_fds=executable is None,
+                    **kwargs,
+                )
+            except OSError as error:
+                # sh runs a file without a #! line as a script, exec doesn't
+                if error.errno != errno.ENOEXEC:
+                    raise
+            if not isinstance(cmd, str):
+                cmd = shlex.join(str(arg) for arg in args)
+        # pylint: disable=consider-using-with
+        return subprocess.Popen(cmd, shell=True, **kwargs)
+
+    @staticmethod
+    def _command_args(cmd):
+        """
+        Return the command as an argument list if it can be run without a
+        shell, along with the path of its executable if that had to be looked
+        up. Returns (None, None) if the command needs a shell.
+        """
+        if isinstance(cmd, (list, tuple)):
+            return cmd, None
+        if _SHELL_CHARS.intersection(cmd):
+            return None, None
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            return None, None
+        # Builtins such as cd or export are not found on the PATH
+        executable = shutil.which(args[0]) if args else None
+        if executable is None:
+            return None, None
+        return args, executable
+
+    def _stream_output(self, proc, display=True, keep_output=True):
+        """
+        Wait for the process to exit, displaying its output as it arrives if
+        display is set. Returns the raw stdout output if keep_output is set,
+        otherwise None. Output is only read
+        until the process exits, so a background job that inherited the pipes
+        can't hold things up.
+        """
+        write = self._output_writer() if display else None
+        stdout_data = bytearray() if keep_output else None
+        # Every read lands in the same buffer instead of a new bytes object
+        read_view = memoryview(bytearray(_READ_SIZE))
+        pidfd = _pidfd_open(proc.pid)
+        with selectors.DefaultSelector() as selector:
+            # Each pipe keeps its group prefix, any partial line until the
+            # rest of it arrives, where its output is collected and whether
+            # the start of the current line is already on screen
+            for stream, prefix, collect in (
+                (proc.stdout, self._group_green, stdout_data),
+                (proc.stderr, self._group_red, None),
+            ):
+                if stream is not None:
+                    os.set_blocking(stream.fileno(), False)
+                    selector.register(
+                        stream,
+                        selectors.EVENT_READ,
+                        [prefix.encode(), bytearray(), collect, False],
+                    )
+            if pidfd is not None:
+                # Readable once the process exits
+                selector.register(pidfd, selectors.EVENT_READ)
+            pipes = len(selector.get_map()) - (pidfd is not None)
+            while pipes:
+                ready = selector.select(None if pidfd is not None else _EXIT_POLL)
+                if proc.poll() is not None:
+                    break
+                for key, _ in ready:
+                    if key.fd == pidfd:
+                        continue
+                    if self._read_output(key, read_view, write) is None:
+                        self._end_output(key, write)
+                        selector.unregister(key.fileobj)
+                        pipes -= 1
+            # The exited process's output is all in the pipes by now, so read
+            # what is there without waiting for anyone else holding them
+            for key in list(selector.get_map().values()):
+                if key.fd != pidfd:
+                    while self._read_output(key, read_view, write):
+                        pass
+                    self._end_output(key, write)
+        if pidfd is not None:
+            os.close(pidfd)
+        return stdout_data
+
+    @staticmethod
+    def _read_output(key, read_view, write):
+        """
+        Read what is available from a pipe and display any complete lines.
+        Returns the number of bytes read, 0 if there is nothing to read right
+        now or None at the end of the output.
+        """
+        prefix, pending, collect, started = key.data
+        try:
+            size = os.readv(key.fd, [read_view])
+        except BlockingIOError:
+            return 0
+        if not size:
+            return None
+        chunk = read_view[:size]
+        if collect is not None:
+            collect += chunk
+        if write is None:
+            return size
+        pending += chunk
+        output = bytearray()
+        for line in _pop_lines(pending):
+            if not started:
+                output += prefix
+            output += line + b"\n\r"
+            started = False
+        # A short read means the pipe is empty for now, so show a partial line
+        # such as a prompt rather than wait for the rest of it
+        if size < _READ_SIZE:
+            # Hold back a trailing \r, which may be the start of a \r\n
+            shown = len(pending) - pending.endswith(b"\r")
+            if shown:
+                if not started:
+                    output += prefix
+                output += pending[:shown]
+                del pending[:shown]
+                started = True
+        key.data[3] = started
+        if output:
+            write(output)
+        return size
+
+    @staticmethod
+    def _end_output(key, write):
+        """
+        Display whatever is left of a pipe's last line
+        """
+        prefix, pending, _, started = key.data
+        if write is not None and (pending or started):
+            # Only a held back \r can be left at the end of the output
+            if not started:
+                pending[:0] = prefix
+            write(bytes(pending).rstrip(b"\r") + b"\n\r")
+            pending.clear()
+            key.data[3] = False
+
+    @staticmethod
+    def _output_writer():
+        """
+        Return a function that writes raw command output bytes to stdout
+        """
+        stdout = sys.stdout
+        buffer = getattr(stdout, "buffer", None)
+        if buffer is None:
+            # Text-only streams such as io.StringIO need the output decoded
+            return lambda data: stdout.write(data.decode("utf-8", "replace"))
+        # Anything already printed has to come out ahead of the command output
+        stdout.flush()
+        if getattr(stdout, "line_buffering", False):
+
+            def write(data):
+                buffer.write(data)
+                buffer.flush()
+
+            return write
+        return buffer.write
+
     def info(self, message, **kwargs):
         """
         Display a message with the group in green
         """
-        if self._group is not None:
-            print(colored.green(self._group) + " " + message, **kwargs)
-        else:
-            print(message, **kwargs)
+        print(self._group_green + str(message), **kwargs)
 
     def warn(self, message, **kwargs):
         """
         Display a message with the group in yellow
         """
-        if self._group is not None:
-            print(colored.yellow(self._group) + " " + message, **kwargs)
-        else:
-            print(message, **kwargs)
+        print(self._group_yellow + str(message), **kwargs)
 
     def bail(self, message=None, **kwargs):
         """
@@ -157,18 +438,13 @@ class Shell:
         """
         Display some information
         """
-        if self._group is not None:
-            print(colored.red(self._group) + " " + message, **kwargs)
-        else:
-            print(message, **kwargs)
+        print(self._group_red + str(message), **kwargs)
 
     @staticmethod
     def print_colored(message, color):
         """Print out a message in a specific color"""
-        colors = ("red", "green", "yellow", "blue", "black", "magenta", "cyan", "white")
-        if color in colors:
-            colorize = getattr(colored, color)
-            print(colorize(message))
+        if color in _ANSI_COLORS:
+            print(_colorize(message, color))
 
     def prompt(self, message, *, default=None, force_arg=None, force_arg_value=True):
         """
@@ -189,10 +465,12 @@ class Shell:
             if reply == "" and default is not None:
                 return default == "y"
 
-            if re.match("y(?:es)?", reply, re.I):
+            # Any reply starting with y or n is taken as a yes or a no
+            answer = reply[:1].lower()
+            if answer == "y":
                 return True
 
-            if re.match("n(?:o)?", reply, re.I):
+            if answer == "n":
                 return False
 
     @staticmethod
@@ -200,14 +478,28 @@ class Shell:
         """
         Clear the screen
         """
-        os.system("clear")
+        if sys.stdout.isatty() and os.environ.get("TERM") != "dumb":
+            sys.stdout.write(_CLEAR_SCREEN)
+            sys.stdout.flush()
+        else:
+            # Let clear work out what, if anything, this terminal needs
+            try:
+                subprocess.run(["clear"], check=False)
+            except FileNotFoundError:
+                pass
 
     @staticmethod
     def reboot():
         """
         Reboot the system
         """
-        os.system("reboot")
+        # PATH often lacks /sbin for users without sudo's secure_path
+        for command in ("reboot", "/sbin/reboot"):
+            try:
+                subprocess.run([command], check=False)
+                return
+            except FileNotFoundError:
+                pass
 
     @staticmethod
     def getcwd():
@@ -223,9 +515,10 @@ class Shell:
         # if directory[0] != "/" and directory[0] != ".":
         #    directory = self.getcwd() + "/" + directory
         directory = self.path(directory)
-        if not self.exists(directory):
+        mode = self._file_mode(directory)
+        if mode is None:
             raise ValueError(f"Directory '{directory}' does not exist")
-        if not self.isdir(directory):
+        if not stat.S_ISDIR(mode):
             raise ValueError(f"The given location '{directory}' is not a directory")
         os.chdir(directory)
 
@@ -261,14 +554,14 @@ class Shell:
         """
         Return the User's home directory
         """
-        return os.path.expanduser("~")
+        return _HOME
 
     @staticmethod
     def is_root():
         """
         Return whether the current user is logged in as root or has super user access
         """
-        return os.geteuid() == 0
+        return _IS_ROOT
 
     @staticmethod
     def script():
@@ -279,10 +572,12 @@ class Shell:
 
     def grep(self, search_term, location):
         """
-        Run the grep command and return the result
+        Search a file for the given term and return whether it was found.
+        The term may also be a compiled regular expression.
         """
-        location = self.path(location)
-        return self.run_command(f"grep {search_term} {location}", suppress_message=True)
+        if not isinstance(search_term, re.Pattern):
+            search_term = re.escape(search_term)
+        return self.pattern_search(location, search_term)
 
     @staticmethod
     def date():
@@ -313,23 +608,24 @@ class Shell:
         returns True/False if found
         """
         location = self.path(location)
-        found = False
-
-        if self.exists(location) and not self.isdir(location):
-            if multi_line:
-                with open(location, "r+", encoding="utf-8") as file:
-                    match = re.search(pattern, file.read(), flags=re.DOTALL)
-                    if match:
-                        found = True
-            else:
-                for line in fileinput.FileInput(location):
-                    match = re.search(pattern, line)
-                    if match:
-                        found = True
-                        break
+        match = None
+
+        mode = self._file_mode(location)
+        if mode is not None and not stat.S_ISDIR(mode):
+            with open(
+                location, "r", encoding="utf-8", errors="replace", buffering=1 << 16
+            ) as file:
+                if multi_line:
+                    match = re.compile(pattern, flags=re.DOTALL).search(file.read())
+                else:
+                    regex = re.compile(pattern)
+                    for line in file:
+                        match = regex.search(line)
+                        if match:
+                            break
         if return_match:
             return match
-        return found
+        return match is not None
 
     def pattern_replace(self, location, pattern, replace="", multi_line=False):
         """
@@ -339,29 +635,48 @@ class Shell:
         line-by-line basis
         """
         location = self.path(location)
-        if self.pattern_search(location, pattern, multi_line):
-            if multi_line:
-                regex = re.compile(pattern, flags=re.DOTALL)
-                with open(location, "r+", encoding="utf-8") as file:
-                    data = file.read()
-                    file.seek(0)
-                    file.write(regex.sub(replace, data))
-                    file.truncate()
-                    file.close()
-            else:
-                regex = re.compile(pattern)
-                for line in fileinput.FileInput(location, inplace=True):
-                    if re.search(pattern, line):
-                        print(regex.sub(replace, line), end="")
-                    else:
-                        print(line, end="")
+        mode = self._file_mode(location)
+        if mode is None or stat.S_ISDIR(mode):
+            return
+        with open(location, "r", encoding="utf-8") as file:
+            data = file.read()
+        if multi_line:
+            new_data = re.compile(pattern, flags=re.DOTALL).sub(replace, data)
+        else:
+            regex = re.compile(pattern)
+            # Split on \n only, the same lines pattern_search() iterates over
+            new_data = "".join(regex.sub(replace, line) for line in io.StringIO(data))
+        if new_data != data:
+            self._replace_file(location, new_data)
+
+    @staticmethod
+    def _replace_file(location, content):
+        # Write to a temporary file next to the original and rename it into
+        # place, so the file is never left half written
+        location = os.path.realpath(location)
+        file_stat = os.stat(location)
+        temp_fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(location), prefix=".", suffix=".tmp"
+        )
+        try:
+            with open(temp_fd, "w", encoding="utf-8") as file:
+                file.write(content)
+            try:
+                os.chmod(temp_path, stat.S_IMODE(file_stat.st_mode))
+                os.chown(temp_path, file_stat.st_uid, file_stat.st_gid)
+            except OSError:
+                # Not every filesystem (e.g. the FAT boot partition) supports this
+                pass
+            os.replace(temp_path, location)
+        except BaseException:
+            os.remove(temp_path)
+            raise
 
     def isdir(self, location):
         """
         Check if a location exists and is a directory
         """
-        location = self.path(location)
-        return os.path.exists(location) and os.path.isdir(location)
+        return os.path.isdir(self.path(location))
 
     def exists(self, location):
         """
@@ -370,15 +685,34 @@ class Shell:
         location = self.path(location)
         return os.path.exists(location)
 
+    @staticmethod
+    def _file_mode(location):
+        # A single stat() covering both the exists and isdir checks
+        try:
+            return os.stat(location).st_mode
+        except OSError:
+            return None
+
     def move(self, source, destination):
         """
         Move a file or directory from source to destination
         """
         source = self.path(source)
         destination = self.path(destination)
-        if os.path.exists(source):
-            if not os.path.isdir(source) and os.path.isdir(destination):
-                destination += os.sep + os.path.basename(source)
+        source_mode = self._file_mode(source)
+        if source_mode is None:
+            return
+        if stat.S_ISDIR(source_mode):
+            shutil.move(source, destination)
+            return
+        if os.path.isdir(destination):
+            destination += os.sep + os.path.basename(source)
+        # A plain rename is all that is needed unless crossing filesystems
+        try:
+            os.replace(source, destination)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
             shutil.move(source, destination)
 
     def copy(self, source, destination):
@@ -387,8 +721,9 @@ class Shell:
         """
         source = self.path(source)
         destination = self.path(destination)
-        if os.path.exists(source):
-            if os.path.isdir(source):
+        source_mode = self._file_mode(source)
+        if source_mode is not None:
+            if stat.S_ISDIR(source_mode):
                 shutil.copytree(source, destination)
             else:
                 if os.path.isdir(destination):
@@ -412,27 +747,31 @@ class Shell:
         if group is None:
             group = user
 
+        # Resolve the names once rather than for every entry in the tree
+        uid = user if isinstance(user, int) else _getpwnam(user).pw_uid
+        gid = group if isinstance(group, int) else grp.getgrnam(group).gr_gid
+
         location = self.path(location)
         if recursive and os.path.isdir(location):
-            for root, dirs, files in os.walk(location):
-                for directory in dirs:
-                    shutil.chown(
-                        os.path.join(root, directory),
-                        user,
-                        group,
-                    )
-                for file in files:
-                    shutil.chown(os.path.join(root, file), user, group)
+            self._chown_tree(location, uid, gid)
         else:
-            shutil.chown(location, user, group)
+            os.chown(location, uid, gid)
+
+    def _chown_tree(self, location, uid, gid):
+        with os.scandir(location) as entries:
+            for entry in entries:
+                os.chown(entry.path, uid, gid, follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    self._chown_tree(entry.path, uid, gid)
 
     def remove(self, location):
         """
         Remove a file or directory if it exists
         """
         location = self.path(location)
-        if os.path.exists(location):
-            if os.path.isdir(location):
+        mode = self._file_mode(location)
+        if mode is not None:
+            if stat.S_ISDIR(mode):
                 shutil.rmtree(location)
             else:
                 os.remove(location)
@@ -450,25 +789,35 @@ class Shell:
         """
         Write the contents to a file at the specified path
         """
-        if append:
-            mode = "a"
-            content = "\n" + content
-        else:
-            mode = "w"
-        with open(self.path(path), mode, encoding="utf-8") as service_file:
+        with self.open_text_file(path, append) as service_file:
+            if append:
+                # Written separately to avoid copying a large content string
+                service_file.write("\n")
             service_file.write(content)
 
+    @contextmanager
+    def open_text_file(self, path, append=True):
+        """
+        Open a file at the specified path for writing and keep it open so that
+        several writes can be made before it is closed
+        """
+        mode = "a" if append else "w"
+        with open(
+            self.path(path), mode, encoding="utf-8", buffering=1 << 16
+        ) as text_file:
+            yield text_file
+
     @staticmethod
     def is_python3():
         "Check if we are running Python 3 or later"
-        return int(platform.python_version()[0]) >= 3
+        return sys.version_info[0] >= 3
 
     @staticmethod
     def is_linux():
         """
         Check that we are running linux
         """
-        return platform.system() == "Linux" or platform.system() == "Darwin"
+        return _SYSTEM in ("Linux", "Darwin")
 
     @staticmethod
     def is_armhf():
@@ -476,83 +825,104 @@ class Shell:
         Check if Platform.machine() (same as uname -m) returns an ARM platform that
         supports hardware floating point
         """
-        return bool(re.match("armv.l", platform.machine()))
+        return _IS_ARMHF
 
     @staticmethod
     def is_armv6():
         """
         Check if Platform.machine() returns ARM v6
         """
-        return platform.machine() == "armv6l"
+        return _MACHINE == "armv6l"
 
     @staticmethod
     def is_armv7():
         """
         Check if Platform.machine() returns ARM v7
         """
-        return platform.machine() == "armv7l"
+        return _MACHINE == "armv7l"
 
     @staticmethod
     def is_armv8():
         """
         Check if Platform.machine() returns ARM v8
         """
-        return platform.machine() == "armv8l"
+        return _MACHINE == "armv8l"
 
     @staticmethod
     def is_arm64():
         """
         Check if Platform.machine() returns ARM 64
         """
-        return platform.machine() == "aarch64"
+        return _MACHINE == "aarch64"
 
     @staticmethod
     def get_arch():
         """Return a string containing the architecture"""
-        return platform.machine()
+        return _MACHINE
 
     # pylint: disable=invalid-name
     def get_os(self):
         """Return a string containing the release which we can use to compare in the script"""
-        os_releases = (
-            "Raspbian",
-            "Debian",
-            "Kano",
-            "Mate",
-            "PiTop",
-            "Ubuntu",
-            "Darwin",
-            "Kali",
-        )
+        if "os" not in self._os_cache:
+            self._os_cache["os"] = self._detect_os()
+        return self._os_cache["os"]
+
+    def _detect_os(self):
         release = None
-        if os.path.exists("/etc/os-release"):
-            with open("/etc/os-release", encoding="utf-8") as f:
-                if "Raspbian" in f.read():
+        release_file = self._read_text("/etc/os-release")
+        if release_file is not None:
+            if "Raspbian" in release_file:
+                release = "Raspbian"
+            rpi_issue = self._read_text("/etc/rpi-issue")
+            if rpi_issue is not None and "Raspberry Pi" in rpi_issue:
+                release = "Raspbian"
+            if shutil.which("apt-get") is not None:
+                release = self._match_os_release(release_file) or release
+                if release == "Debian" and rpi_issue is not None:
                     release = "Raspbian"
-            if self.exists("/etc/rpi-issue"):
-                with open("/etc/rpi-issue", encoding="utf-8") as f:
-                    if "Raspberry Pi" in f.read():
-                        release = "Raspbian"
-            if self.run_command("command -v apt-get", suppress_message=True):
-                with open("/etc/os-release", encoding="utf-8") as f:
-                    release_file = f.read()
-                    for opsys in os_releases:
-                        if opsys in release_file:
-                            release = opsys
-                if release == "Debian" and os.path.exists("/etc/rpi-issue"):
-                    release = "Raspbian"
-        if os.path.isdir(os.path.expanduser("~/.kano-settings")) or os.path.isdir(
-            os.path.expanduser("~/.kanoprofile")
+        if os.path.isdir(os.path.join(_HOME, ".kano-settings")) or os.path.isdir(
+            os.path.join(_HOME, ".kanoprofile")
         ):
             release = "Kano"
-        if os.path.isdir(os.path.expanduser("~/.config/ubuntu-mate")):
+        if os.path.isdir(os.path.join(_HOME, ".config", "ubuntu-mate")):
             release = "Mate"
-        if platform.system() == "Darwin":
+        if _SYSTEM == "Darwin":
             release = "Darwin"
         return release
 
+    @staticmethod
+    def _match_os_release(release_file):
+        # Look for a known name in the identifying fields, most specific first
+        fields = {}
+        for line in release_file.splitlines():
+            key, _, value = line.partition("=")
+            fields[key.strip()] = value.strip().strip("\"'")
+        for field in ("ID", "NAME", "PRETTY_NAME", "ID_LIKE"):
+            for token in fields.get(field, "").split():
+                if token.lower() in _OS_NAMES:
+                    return _OS_NAMES[token.lower()]
+        # Otherwise use the last known name that appears anywhere in the file
+        for opsys in reversed(_OS_RELEASES):
+            if opsys in release_file:
+                return opsys
+        return None
+
+    @staticmethod
+    def _read_text(location):
+        # Return the contents of a small text file, or None if it is missing
+        try:
+            with open(location, encoding="utf-8") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
     def get_raspbian_version(self):
         """Return a string containing the raspbian version"""
+        if "raspbian_version" not in self._os_cache:
+            self._os_cache["raspbian_version"] = self._detect_raspbian_version()
+        return self._os_cache["raspbian_version"]
+
+    def _detect_raspbian_version(self):
         if self.get_os() != "Raspbian":
             return None
         raspbian_releases = (
@@ -563,14 +933,13 @@ class Shell:
             "jessie",
             "wheezy",
         )
-        if os.path.exists("/etc/os-release"):
-            with open("/etc/os-release", encoding="utf-8") as f:
-                release_file = f.read()
-                if "/sid" in release_file:
-                    return "unstable"
-                for raspbian in raspbian_releases:
-                    if raspbian in release_file:
-                        return raspbian
+        release_file = self._read_text("/etc/os-release")
+        if release_file is not None:
+            if "/sid" in release_file:
+                return "unstable"
+            for raspbian in raspbian_releases:
+                if raspbian in release_file:
+                    return raspbian
         return None
 
     def prompt_reboot(self, default="y", **kwargs):
@@ -617,41 +986,51 @@ class Shell:
         return self.get_os() == "Raspbian"
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def is_raspberry_pi():
         """
         Use PlatformDetect to check if this is a Raspberry Pi
         """
-        detector = adafruit_platformdetect.Detector()
-        return detector.board.any_raspberry_pi
+        return _detector().board.any_raspberry_pi
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_board_model():
         """
         Use PlatformDetect to get the board model
         """
-        detector = adafruit_platformdetect.Detector()
-        return detector.board.id
+        return _detector().board.id
 
     @staticmethod
     def get_architecture():
         """
         Get the type of Processor
         """
-        return platform.machine()
+        return _MACHINE
 
     @staticmethod
     def kernel_minimum(version):
         """
-        Check that we are running on at least the specified version
+        Check that we are running on at least the specified version, which may
+        be given as a string such as "5.10", a number or a tuple or list of
+        integers
         """
-        return platform.release() >= str(version)
+        if isinstance(version, list):
+            # The parsed versions are cached, which needs a hashable argument
+            version = tuple(version)
+        try:
+            kernel = _version_tuple(_RELEASE)
+        except ValueError:
+            # Nothing we can compare against, so don't claim to meet the minimum
+            kernel = (0, 0, 0)
+        return kernel >= _version_tuple(version)
 
     @staticmethod
     def release():
         """
         Return the latest kernel release version
         """
-        return platform.release()
+        return _RELEASE
 
     def argument_exists(self, arg, prefix="-"):
         """
@@ -675,7 +1054,16 @@ class Shell:
 
     @group.setter
     def group(self, value):
+        # Messages always start with the prefix, which is empty without a group
+        if value is None:
+            self._group = None
+            self._group_green = self._group_yellow = self._group_red = ""
+            return
         self._group = str(value)
+        # Render the colored prefixes once instead of for every message
+        self._group_green = _colorize(self._group, "green") + " "
+        self._group_yellow = _colorize(self._group, "yellow") + " "
+        self._group_red = _colorize(self._group, "red") + " "
 
     @property
     def args(self):